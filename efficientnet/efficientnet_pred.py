@@ -41,16 +41,19 @@ EfficientNet models for Keras.
 
 import os
 import math
+import inspect
+import collections
 import warnings
+import h5py
 import numpy as np
 import tensorflow as tf 
+from concurrent.futures import ThreadPoolExecutor
 
-from keras.preprocessing import image
 from keras.layers import add, multiply
 from keras.layers import Conv2D, Input, Dense, Dropout, Reshape, Activation, DepthwiseConv2D, \
-    BatchNormalization, ZeroPadding2D, GlobalAveragePooling2D, GlobalMaxPooling2D
+    BatchNormalization, ZeroPadding2D, GlobalAveragePooling2D, GlobalMaxPooling2D, Permute, Lambda
 
-from keras.models import Model
+from keras.models import Model, clone_model
 from keras.utils.data_utils import get_file
 from keras.engine.topology import get_source_inputs
 
@@ -64,6 +67,10 @@ gpus = tf.config.experimental.list_physical_devices('GPU')
 for gpu in gpus:
     tf.config.experimental.set_memory_growth(gpu, True)
 
+# Let cuDNN autotune the algorithm of every convolution shape. The first inference call 
+# pays for the autotuning, so leave it out of latency measurements.
+os.environ.setdefault('TF_CUDNN_USE_AUTOTUNE', '1')
+
 
 BASE_WEIGHTS_PATH = (
     'https://github.com/Callidior/keras-applications/'
@@ -88,22 +95,26 @@ WEIGHTS_HASHES = {
 }
 
 
-DEFAULT_BLOCKS_ARGS = [
-    {'kernel_size': 3, 'repeats': 1, 'filters_in': 32, 'filters_out': 16,
-     'expand_ratio': 1, 'id_skip': True, 'strides': 1, 'se_ratio': 0.25},
-    {'kernel_size': 3, 'repeats': 2, 'filters_in': 16, 'filters_out': 24,
-     'expand_ratio': 6, 'id_skip': True, 'strides': 2, 'se_ratio': 0.25},
-    {'kernel_size': 5, 'repeats': 2, 'filters_in': 24, 'filters_out': 40,
-     'expand_ratio': 6, 'id_skip': True, 'strides': 2, 'se_ratio': 0.25},
-    {'kernel_size': 3, 'repeats': 3, 'filters_in': 40, 'filters_out': 80,
-     'expand_ratio': 6, 'id_skip': True, 'strides': 2, 'se_ratio': 0.25},
-    {'kernel_size': 5, 'repeats': 3, 'filters_in': 80, 'filters_out': 112,
-     'expand_ratio': 6, 'id_skip': True, 'strides': 1, 'se_ratio': 0.25},
-    {'kernel_size': 5, 'repeats': 4, 'filters_in': 112, 'filters_out': 192,
-     'expand_ratio': 6, 'id_skip': True, 'strides': 2, 'se_ratio': 0.25},
-    {'kernel_size': 3, 'repeats': 1, 'filters_in': 192, 'filters_out': 320,
-     'expand_ratio': 6, 'id_skip': True, 'strides': 1, 'se_ratio': 0.25}
-]
+# Immutable block arguments; EfficientNet() derives the scaled ones with _replace().
+_BlockSpec = collections.namedtuple('_BlockSpec', 
+    ['kernel_size', 'repeats', 'filters_in', 'filters_out',
+     'expand_ratio', 'id_skip', 'strides', 'se_ratio'])
+
+DEFAULT_BLOCKS_ARGS = (
+    _BlockSpec(kernel_size=3, repeats=1, filters_in=32, filters_out=16,
+               expand_ratio=1, id_skip=True, strides=1, se_ratio=0.25),
+    _BlockSpec(kernel_size=3, repeats=2, filters_in=16, filters_out=24,
+               expand_ratio=6, id_skip=True, strides=2, se_ratio=0.25),
+    _BlockSpec(kernel_size=5, repeats=2, filters_in=24, filters_out=40,
+               expand_ratio=6, id_skip=True, strides=2, se_ratio=0.25),
+    _BlockSpec(kernel_size=3, repeats=3, filters_in=40, filters_out=80,
+               expand_ratio=6, id_skip=True, strides=2, se_ratio=0.25),
+    _BlockSpec(kernel_size=5, repeats=3, filters_in=80, filters_out=112,
+               expand_ratio=6, id_skip=True, strides=1, se_ratio=0.25),
+    _BlockSpec(kernel_size=5, repeats=4, filters_in=112, filters_out=192,
+               expand_ratio=6, id_skip=True, strides=2, se_ratio=0.25),
+    _BlockSpec(kernel_size=3, repeats=1, filters_in=192, filters_out=320,
+               expand_ratio=6, id_skip=True, strides=1, se_ratio=0.25))
 
 CONV_KERNEL_INITIALIZER = {
     'class_name': 'VarianceScaling',
@@ -128,16 +139,37 @@ DENSE_KERNEL_INITIALIZER = {
 }
 
 
-def correct_pad(K, inputs, kernel_size):
+# Resolve the backend settings once instead of querying them for every layer.
+_DATA_FORMAT = K.image_data_format()
+
+# TensorFlow 2.3 only ships the mixed precision policy API under `experimental`.
+if hasattr(tf.keras.mixed_precision, 'set_global_policy'):
+    _global_policy = tf.keras.mixed_precision.global_policy
+    _set_global_policy = tf.keras.mixed_precision.set_global_policy
+else:
+    _global_policy = tf.keras.mixed_precision.experimental.global_policy
+    _set_global_policy = tf.keras.mixed_precision.experimental.set_policy
+
+DTYPE_POLICIES = {'float32', 'mixed_float16', 'mixed_bfloat16'}
+
+# TensorFlow 2.3 and 2.4 call the XLA switch of tf.function `experimental_compile`.
+_JIT_COMPILE_ARG = ('jit_compile' if 'jit_compile' in inspect.signature(tf.function).parameters
+                    else 'experimental_compile')
+
+TRT_PRECISIONS = {'fp32', 'fp16', 'int8'}
+
+
+def correct_pad(K, inputs, kernel_size, data_format=_DATA_FORMAT):
     # Return a tuple for zero-padding for 2D convolution with downsampling.
     """
     # Arguments
         input_size: An integer or tuple/list of 2 integers.
         kernel_size: An integer or tuple/list of 2 integers.
+        data_format: 'channels_last' or 'channels_first' layout of `inputs`.
     # Returns
         A tuple.
     """
-    img_dim = 1 if K.image_data_format() == 'channels_last' else 2
+    img_dim = 1 if data_format == 'channels_last' else 2
     input_size = K.int_shape(inputs)[img_dim:(img_dim + 2)]
 
     if isinstance(kernel_size, int):
@@ -154,6 +186,26 @@ def correct_pad(K, inputs, kernel_size):
             (correct[1] - adjust[1], correct[1]))
 
 
+def correct_pad_static(input_size, kernel_size):
+    # Return the padding of correct_pad() from statically known spatial dimensions.
+    """
+    # Arguments
+        input_size: tuple of 2 integers, `None` for a dimension unknown at build time.
+        kernel_size: An integer.
+    # Returns
+        A tuple.
+    """
+    correct = kernel_size >> 1
+    # Even (or unknown) dimensions drop one pixel of leading padding: ~size & 1 is 1 if even.
+    return tuple((correct - (1 if size is None else ~size & 1), correct) for size in input_size)
+
+
+def _downsampled(input_size):
+    # Spatial dimensions after a stride 2 convolution padded by correct_pad_static().
+
+    return tuple(None if size is None else (size + 1) >> 1 for size in input_size)
+
+
 def swish(x):
   # Swish activation function.
     """
@@ -162,23 +214,24 @@ def swish(x):
     # Returns
         The Swish activation: `x * sigmoid(x)`.)
     """
-    if K.backend() == 'tensorflow':
-        try:
-            # Implement the memory-efficient gradient
-            return tf.nn.swish(x)
-        except AttributeError:
-            pass
+    # TensorFlow >= 2.3 always provides the fused kernel with a memory-efficient gradient.
+    return tf.nn.swish(x)
+
 
-    return x * K.sigmoid(x)
+def _spatial_mean(x, axis, keepdims):
+    # Average over the spatial axes in one reduction; the SE squeeze of block().
+
+    return tf.reduce_mean(x, axis=axis, keepdims=keepdims)
 
 
 def block(inputs, activation_fn=swish, drop_rate=0., name='', filters_in=32, filters_out=16, 
-	      kernel_size=3, strides=1, expand_ratio=1, se_ratio=0., id_skip=True):
+	      kernel_size=3, strides=1, expand_ratio=1, se_ratio=0., id_skip=True,
+	      data_format=_DATA_FORMAT, input_size=None):
     # A mobile inverted residual block.
     """
     # Arguments
         inputs: input tensor.
-        activation_fn: activation function.
+        activation_fn: activation function, or an `Activation` layer to share.
         drop_rate: float between 0 and 1, fraction of the input units to drop.
         name: string, block label.
         filters_in: integer, the number of input filters.
@@ -188,58 +241,68 @@ def block(inputs, activation_fn=swish, drop_rate=0., name='', filters_in=32, fil
         expand_ratio: integer, scaling coefficient for the input filters.
         se_ratio: float between 0 and 1, fraction to squeeze the input filters.
         id_skip: boolean.
+        data_format: 'channels_last' or 'channels_first' layout of `inputs`.
+        input_size: optional tuple of the 2 spatial dimensions of `inputs`, if they 
+            are tracked by the caller; avoids querying the tensor shape.
     # Returns
         output tensor for the block.
     """
-    bn_axis = -1 if K.image_data_format() == 'channels_last' else 1
+    bn_axis = -1 if data_format == 'channels_last' else 1
+    filters = filters_in * expand_ratio
+
+    # The activation is stateless, so a single layer serves every call site.
+    if isinstance(activation_fn, Activation):
+        activation = activation_fn
+    else:
+        activation = Activation(activation_fn, name=name+'block_activation')
 
     # Expansion phase
-    filters = filters_in * expand_ratio
     if expand_ratio != 1:
         x = Conv2D(filters, kernel_size=(1,1), padding='same', use_bias=False,
-                   kernel_initializer=CONV_KERNEL_INITIALIZER,
+                   kernel_initializer=CONV_KERNEL_INITIALIZER, data_format=data_format,
                    name=name + 'expand_conv')(inputs)
         x = BatchNormalization(axis=bn_axis, name=name+'expand_bn')(x)
-        x = Activation(activation_fn, name=name+'expand_activation')(x)
+        x = activation(x)
     else:
         x = inputs
 
     # Conduct the Depthwise Convolution
     if strides == 2:
-        x = ZeroPadding2D(padding=correct_pad(K,x,kernel_size), name=name+'dwconv_pad')(x)
+        if input_size is None:
+            padding = correct_pad(K,x,kernel_size,data_format)
+        else:
+            padding = correct_pad_static(input_size, kernel_size)
+        x = ZeroPadding2D(padding=padding, data_format=data_format, name=name+'dwconv_pad')(x)
         conv_pad = 'valid'
     else:
         conv_pad = 'same'
     x = DepthwiseConv2D(kernel_size, strides=strides, padding=conv_pad, use_bias=False,
-                        depthwise_initializer=CONV_KERNEL_INITIALIZER, name=name+'dwconv')(x)
+                        depthwise_initializer=CONV_KERNEL_INITIALIZER, data_format=data_format,
+                        name=name+'dwconv')(x)
     x = BatchNormalization(axis=bn_axis, name=name+'bn')(x)
-    x = Activation(activation_fn, name=name+'activation')(x)
+    x = activation(x)
 
     # Squeeze and Excitation phase
     if 0 < se_ratio <= 1:
         filters_se = max(1, int(filters_in*se_ratio))
-        se = GlobalAveragePooling2D(name=name+'se_squeeze')(x)
-
-        if bn_axis == -1:
-        	se = Reshape((1,1,filters), name=name+'se_reshape')(se)
-        else:
-        	se = Reshape((filters,1,1), name=name+'se_reshape')(se)
-
-        se = Conv2D(filters_se, kernel_size=(1,1), padding='same', activation=activation_fn,
-                    kernel_initializer=CONV_KERNEL_INITIALIZER, name=name+'se_reduce')(se)
-        se = Conv2D(filters, kernel_size=(1,1), padding='same', activation='sigmoid',
-                    kernel_initializer=CONV_KERNEL_INITIALIZER, name=name+'se_expand')(se)
-
-        if K.backend() == 'theano':
-            # For the Theano backend, make the excitation weights broadcastable explicitly. 
-            se = Lambda(lambda x: K.pattern_broadcast(x, [True,True,True,False]),
-                        output_shape=lambda input_shape: input_shape, 
-                        name=name+'se_broadcast')(se)
+        # Squeeze and excite with matmuls on the channel axis, then broadcast over space. 
+        # With channels last the kept (1, 1, filters) shape needs no reshape at all.
+        channels_last = bn_axis == -1
+        se = Lambda(_spatial_mean, name=name+'se_squeeze',
+                    arguments={'axis': [1,2] if channels_last else [2,3],
+                               'keepdims': channels_last})(x)
+        se = Dense(filters_se, activation=activation.activation,
+                   kernel_initializer=CONV_KERNEL_INITIALIZER, name=name+'se_reduce')(se)
+        se = Dense(filters, activation='sigmoid',
+                   kernel_initializer=CONV_KERNEL_INITIALIZER, name=name+'se_expand')(se)
+        if not channels_last:
+            se = Reshape((filters,1,1), name=name+'se_reshape')(se)
         x = multiply([x,se], name=name+'se_excite')
 
     # Output phase
     x = Conv2D(filters_out, kernel_size=(1,1), padding='same', use_bias=False,
-               kernel_initializer=CONV_KERNEL_INITIALIZER, name=name+'project_conv')(x)
+               kernel_initializer=CONV_KERNEL_INITIALIZER, data_format=data_format,
+               name=name+'project_conv')(x)
     x = BatchNormalization(axis=bn_axis, name=name+'project_bn')(x)
     if (id_skip is True and strides == 1 and filters_in == filters_out):
         if drop_rate > 0:
@@ -249,11 +312,56 @@ def block(inputs, activation_fn=swish, drop_rate=0., name='', filters_in=32, fil
     return x
 
 
+def load_h5_weights(model, filepath):
+    # Load Keras HDF5 weights by layer name.
+    """
+    The pretrained files store the SE layers as 1x1 convolutions, whose (1, 1, in, out) 
+    kernels hold the same values as the (in, out) kernels of the Dense layers used here. 
+    That is the only reshape applied; every other weight must match exactly.
+    # Arguments
+        model: Keras model instance.
+        filepath: path of a file written by `save_weights()` or `save()` in HDF5 format.
+    # Raises
+        ValueError: if a layer with weights is missing from the file, or the number 
+            or shapes of its weights do not match.
+    """
+    with h5py.File(filepath, 'r') as f:
+        group = f['model_weights'] if 'layer_names' not in f.attrs else f
+        for layer in model.layers:
+            if not layer.weights:
+                continue
+            if layer.name not in group:
+                raise ValueError('Layer {} is missing from the weights file {}'.format(
+                    layer.name, filepath))
+            weight_names = [name.decode('utf8') if isinstance(name, bytes) else name
+                            for name in group[layer.name].attrs['weight_names']]
+            values = [np.asarray(group[layer.name][name]) for name in weight_names]
+            if len(values) != len(layer.weights):
+                raise ValueError('Layer {} expects {} weights, but the weights file {} '
+                                 'holds {}'.format(layer.name, len(layer.weights), 
+                                                   filepath, len(values)))
+
+            for i, weight in enumerate(layer.weights):
+                shape = K.int_shape(weight)
+                if values[i].shape == shape:
+                    continue
+                # The kernel is the first weight of a Dense layer.
+                if isinstance(layer, Dense) and i == 0 and values[i].shape == (1, 1) + shape:
+                    values[i] = np.reshape(values[i], shape)
+                else:
+                    raise ValueError('Weight {} of layer {} has shape {}, but the weights '
+                                     'file {} holds shape {}'.format(
+                                         weight.name, layer.name, shape, filepath, 
+                                         values[i].shape))
+            layer.set_weights(values)
+
+
 def EfficientNet(width_coefficient, depth_coefficient, default_size, dropout_rate=0.2,
                  drop_connect_rate=0.2, depth_divisor=8, activation_fn=swish,
                  blocks_args=DEFAULT_BLOCKS_ARGS, model_name='efficientnet',
                  include_top=True, weights='imagenet', input_tensor=None,
-                 input_shape=None, pooling=None, num_classes=1000, **kwargs):
+                 input_shape=None, pooling=None, num_classes=1000,
+                 dtype_policy=None, data_format=None, **kwargs):
     # Instantiates the EfficientNet architecture using given scaling coefficients.
     """
     # Arguments
@@ -264,7 +372,8 @@ def EfficientNet(width_coefficient, depth_coefficient, default_size, dropout_rat
         drop_connect_rate: float, dropout rate at skip connections.
         depth_divisor: integer, a unit of network width.
         activation_fn: activation function.
-        blocks_args: list of dicts, parameters to construct block modules.
+        blocks_args: sequence of `_BlockSpec` tuples (or dicts with the same keys), 
+            parameters to construct block modules.
         model_name: string, model name.
         include_top: whether to include the FC layer at the top of the network.
         weights: `None` (random initialization), 'imagenet' or the path to any weights.
@@ -275,10 +384,20 @@ def EfficientNet(width_coefficient, depth_coefficient, default_size, dropout_rat
             - `avg` means global average pooling and the output as a 2D tensor.
             - `max` means global max pooling will be applied.
         num_classes: specified if `include_top` is True
+        dtype_policy: `None` to keep the current global Keras policy, or one of 
+            'float32', 'mixed_float16' (tensor cores on Volta and newer) or 
+            'mixed_bfloat16' to build with that policy only. The classifier head 
+            always stays in float32.
+        data_format: layout used inside the network, `None` for the Keras config, or 
+            'channels_last' / 'channels_first'. Opting into 'channels_first' can help 
+            float32 GPU inference; mixed precision tensor cores prefer 'channels_last', 
+            and TensorFlow on CPU does not run channels_first depthwise convolutions. 
+            Inputs and 4D outputs keep the layout of the Keras config either way.
     # Returns
         A Keras model instance.
     # Raises
-        ValueError: in case of invalid argument for `weights` or invalid input shape.
+        ValueError: in case of invalid argument for `weights`, `dtype_policy`, 
+            `data_format` or invalid input shape.
     """
     if not (weights in {'imagenet', None} or os.path.exists(weights)):
         raise ValueError('The `weights` argument should be either '
@@ -290,11 +409,19 @@ def EfficientNet(width_coefficient, depth_coefficient, default_size, dropout_rat
         raise ValueError('If using `weights` as `"imagenet"` with `include_top`'
                          ' as true, `classes` should be 1000')
 
+    if dtype_policy is not None and dtype_policy not in DTYPE_POLICIES:
+        raise ValueError('The `dtype_policy` argument should be one of '
+                         '{}, got {}'.format(sorted(DTYPE_POLICIES), dtype_policy))
+
+    if data_format not in {None, 'channels_last', 'channels_first'}:
+        raise ValueError('The `data_format` argument should be either `None`, '
+                         '`channels_last` or `channels_first`, got {}'.format(data_format))
+
     # Determine the proper input shape
     input_shape = _obtain_input_shape(input_shape,
                                       default_size=default_size,
                                       min_size=32,
-                                      data_format=K.image_data_format(),
+                                      data_format=_DATA_FORMAT,
                                       require_flatten=include_top,
                                       weights=weights)
 
@@ -306,7 +433,10 @@ def EfficientNet(width_coefficient, depth_coefficient, default_size, dropout_rat
         else:
             img_input = input_tensor
 
-    bn_axis = -1 if K.image_data_format() == 'channels_last' else 1
+    # Pretrained kernels do not depend on the layout, so weights load in either format.
+    if data_format is None:
+        data_format = _DATA_FORMAT
+    bn_axis = -1 if data_format == 'channels_last' else 1
 
     def round_filters(filters, divisor=depth_divisor):
         # Round number of filters based on depth multiplier.
@@ -323,63 +453,18 @@ def EfficientNet(width_coefficient, depth_coefficient, default_size, dropout_rat
 
         return int(math.ceil(depth_coefficient*repeats))
 
-    # Build the stem
-    x = img_input
-    x = ZeroPadding2D(padding=correct_pad(K,x,3), name='stem_conv_pad')(x)
-    x = Conv2D(round_filters(32), kernel_size=(3,3), strides=2, padding='valid', use_bias=False,
-               kernel_initializer=CONV_KERNEL_INITIALIZER, name='stem_conv')(x)
-    x = BatchNormalization(axis=bn_axis, name='stem_bn')(x)
-    x = Activation(activation_fn, name='stem_activation')(x)
-
-    # Build the blocks
-    from copy import deepcopy
-    blocks_args = deepcopy(blocks_args) # See the above blocks_args
-
-    b = 0
-    blocks = float(sum(args['repeats'] for args in blocks_args))
-    for (i, args) in enumerate(blocks_args):
-        assert args['repeats'] > 0
-        # Update the block input and output filters based on depth multiplier.
-        args['filters_in'] = round_filters(args['filters_in'])
-        args['filters_out'] = round_filters(args['filters_out'])
-
-        for j in range(round_repeats(args.pop('repeats'))):
-            # The first block needs to take care of stride and filter size growth.
-            if j > 0:
-                args['strides'] = 1
-                args['filters_in'] = args['filters_out']
-            x = block(x, activation_fn, drop_connect_rate * b / blocks,
-                      name='block{}{}_'.format(i+1, chr(j+97)), **args)
-            b += 1
-
-    # Build the top
-    x = Conv2D(round_filters(1280), kernel_size=(1,1), padding='same', use_bias=False,
-               kernel_initializer=CONV_KERNEL_INITIALIZER, name='top_conv')(x)
-    x = BatchNormalization(axis=bn_axis, name='top_bn')(x)
-    x = Activation(activation_fn, name='top_activation')(x)
-
-    if include_top:
-        x = GlobalAveragePooling2D(name='avg_pool')(x)
-        if dropout_rate > 0:
-            x = Dropout(dropout_rate, name='top_dropout')(x)
-        x = Dense(num_classes, activation='softmax',
-                  kernel_initializer=DENSE_KERNEL_INITIALIZER, name='probs')(x)
-    else:
-        if pooling == 'avg':
-            x = GlobalAveragePooling2D(name='avg_pool')(x)
-        elif pooling == 'max':
-            x = GlobalMaxPooling2D(name='max_pool')(x)
-
-    # Ensure the model considers any potential predecessors of `input_tensor`.
-    if input_tensor is not None:
-        inputs = get_source_inputs(input_tensor)
-    else:
-        inputs = img_input
+    blocks_args = [args if isinstance(args, _BlockSpec) else _BlockSpec(**args)
+                   for args in blocks_args]
 
-    # Build the model.
-    model = Model(inputs, x, name=model_name)
+    # Round every distinct filter count of the stem, blocks and top once.
+    unique_filters = {32, 1280}
+    for args in blocks_args:
+        unique_filters.update((args.filters_in, args.filters_out))
+    rounded_filters = {filters: round_filters(filters) for filters in unique_filters}
 
-    # Load weights.
+    # Download the pretrained weights in the background while the graph is being built. 
+    # This starts only once the arguments and input shape are known to be valid.
+    weights_future = None
     if weights == 'imagenet':
         if include_top:
             file_suff = '_weights_tf_dim_ordering_tf_kernels_autoaugment.h5'
@@ -388,15 +473,413 @@ def EfficientNet(width_coefficient, depth_coefficient, default_size, dropout_rat
             file_suff = '_weights_tf_dim_ordering_tf_kernels_autoaugment_notop.h5'
             file_hash = WEIGHTS_HASHES[model_name[-2:]][1]
         file_name = model_name + file_suff
-        weights_path = get_file(file_name, BASE_WEIGHTS_PATH + file_name,
-                                cache_subdir='models', file_hash=file_hash)
-        model.load_weights(weights_path)
+        executor = ThreadPoolExecutor(max_workers=1)
+        weights_future = executor.submit(get_file, file_name, BASE_WEIGHTS_PATH + file_name,
+                                         cache_subdir='models', file_hash=file_hash)
+        executor.shutdown(wait=False)
+
+    # Layers pick up the dtype policy when constructed; restore the caller's policy afterwards.
+    if dtype_policy is not None:
+        previous_policy = _global_policy()
+        _set_global_policy(dtype_policy)
+    try:
+        # Share one stateless activation layer across the blocks. The stem and top keep 
+        # their own layers so `stem_activation` and `top_activation` stay feature taps.
+        activation = Activation(activation_fn, name='block_activation')
+
+        # Track the spatial dimensions in Python instead of querying every strided tensor.
+        img_dim = 1 if _DATA_FORMAT == 'channels_last' else 2
+        input_size = K.int_shape(img_input)[img_dim:(img_dim + 2)]
+
+        # Build the stem
+        x = img_input
+        if data_format != _DATA_FORMAT:
+            x = Permute((3,1,2) if data_format == 'channels_first' else (2,3,1),
+                        name='stem_transpose')(x)
+        x = ZeroPadding2D(padding=correct_pad_static(input_size, 3), data_format=data_format,
+                          name='stem_conv_pad')(x)
+        input_size = _downsampled(input_size)
+        x = Conv2D(rounded_filters[32], kernel_size=(3,3), strides=2, padding='valid', use_bias=False,
+                   kernel_initializer=CONV_KERNEL_INITIALIZER, data_format=data_format,
+                   name='stem_conv')(x)
+        x = BatchNormalization(axis=bn_axis, name='stem_bn')(x)
+        x = Activation(activation_fn, name='stem_activation')(x)
+
+        # Build the blocks
+        b = 0
+        blocks = float(sum(args.repeats for args in blocks_args))
+        for (i, args) in enumerate(blocks_args):
+            assert args.repeats > 0
+            # Update the block input and output filters based on depth multiplier.
+            args = args._replace(filters_in=rounded_filters[args.filters_in],
+                                 filters_out=rounded_filters[args.filters_out])
+
+            for j in range(round_repeats(args.repeats)):
+                # The first block needs to take care of stride and filter size growth.
+                if j > 0:
+                    args = args._replace(strides=1, filters_in=args.filters_out)
+                x = block(x, activation, drop_connect_rate * b / blocks,
+                          name='block{}{}_'.format(i+1, chr(j+97)),
+                          filters_in=args.filters_in, filters_out=args.filters_out,
+                          kernel_size=args.kernel_size, strides=args.strides,
+                          expand_ratio=args.expand_ratio, se_ratio=args.se_ratio,
+                          id_skip=args.id_skip, data_format=data_format,
+                          input_size=input_size)
+                if args.strides == 2:
+                    input_size = _downsampled(input_size)
+                b += 1
+
+        # Build the top
+        x = Conv2D(rounded_filters[1280], kernel_size=(1,1), padding='same', use_bias=False,
+                   kernel_initializer=CONV_KERNEL_INITIALIZER, data_format=data_format,
+                   name='top_conv')(x)
+        x = BatchNormalization(axis=bn_axis, name='top_bn')(x)
+        x = Activation(activation_fn, name='top_activation')(x)
+
+        if include_top:
+            x = GlobalAveragePooling2D(data_format=data_format, name='avg_pool')(x)
+            if dropout_rate > 0:
+                x = Dropout(dropout_rate, name='top_dropout')(x)
+            x = Dense(num_classes, activation='softmax',
+                      kernel_initializer=DENSE_KERNEL_INITIALIZER, dtype='float32',
+                      name='probs')(x)
+        else:
+            if pooling == 'avg':
+                x = GlobalAveragePooling2D(data_format=data_format, name='avg_pool')(x)
+            elif pooling == 'max':
+                x = GlobalMaxPooling2D(data_format=data_format, name='max_pool')(x)
+            elif data_format != _DATA_FORMAT:
+                x = Permute((2,3,1) if data_format == 'channels_first' else (3,1,2),
+                            name='top_transpose')(x)
+
+        # Ensure the model considers any potential predecessors of `input_tensor`.
+        if input_tensor is not None:
+            inputs = get_source_inputs(input_tensor)
+        else:
+            inputs = img_input
+
+        # Build the model.
+        model = Model(inputs, x, name=model_name)
+    except BaseException:
+        # Drop a download that has not started yet; one already running finishes, since 
+        # get_file() cannot be interrupted.
+        if weights_future is not None:
+            weights_future.cancel()
+        raise
+    finally:
+        if dtype_policy is not None:
+            _set_global_policy(previous_policy)
+
+    # Load weights.
+    if weights == 'imagenet':
+        load_h5_weights(model, weights_future.result())
     elif weights is not None:
-        model.load_weights(weights)
+        if h5py.is_hdf5(weights):
+            load_h5_weights(model, weights)
+        else:
+            model.load_weights(weights)
 
     return model
 
 
+def _fold_batch_norm(conv, bn):
+    # Return the weights of `conv` with the inference-mode `bn` folded into them.
+    weights = conv.get_weights()
+    kernel = weights[0]
+    bias = weights[1] if conv.use_bias else 0.
+    gamma = K.get_value(bn.gamma) if bn.scale else 1.
+    beta = K.get_value(bn.beta) if bn.center else 0.
+    mean = K.get_value(bn.moving_mean)
+    scale = gamma / np.sqrt(K.get_value(bn.moving_variance) + bn.epsilon)
+
+    if isinstance(conv, DepthwiseConv2D):
+        # The output channels of a depthwise kernel are (input channel, multiplier) pairs.
+        kernel = kernel * np.reshape(scale, kernel.shape[2:])
+    else:
+        kernel = kernel * scale
+    bias = beta + (bias - mean) * scale
+
+    return [kernel, bias]
+
+
+def fuse_for_inference(model):
+    # Fold BatchNormalization (and a following Activation) into the preceding convolution.
+    """
+    Every `Conv2D`/`DepthwiseConv2D -> BatchNormalization` pair becomes a single biased 
+    convolution with W' = W * gamma / sqrt(var + eps) and b' = beta + (b - mean) * 
+    gamma / sqrt(var + eps). When the BN output only feeds an `Activation`, the activation 
+    moves into the convolution too. Folded layers are replaced by identity activations, 
+    so all layer names are kept. The result is only valid for inference.
+    # Arguments
+        model: functional Keras model, for instance the output of `EfficientNetB0()`.
+    # Returns
+        A new Keras model with the folded weights.
+    """
+    config = model.get_config()
+    layers = {layer.name: layer for layer in model.layers}
+    output_names = {output[0] for output in config['output_layers']}
+
+    producers, consumers = {}, {}
+    for layer_config in config['layers']:
+        for node in layer_config['inbound_nodes']:
+            for inbound in node:
+                producers.setdefault(layer_config['name'], []).append(inbound[0])
+                consumers.setdefault(inbound[0], []).append(layer_config['name'])
+
+    # Collect the conv -> (bn, activation or None) chains that can be folded.
+    fused = {}
+    for conv in model.layers:
+        if type(conv) not in (Conv2D, DepthwiseConv2D) or conv.name in output_names:
+            continue
+        following = consumers.get(conv.name, [])
+        if len(following) != 1 or conv.get_config()['activation'] != 'linear':
+            continue
+        bn = layers[following[0]]
+        channel_axis = 3 if conv.data_format == 'channels_last' else 1
+        if not isinstance(bn, BatchNormalization) or list(bn.axis) != [channel_axis]:
+            continue
+
+        activation = None
+        following = consumers.get(bn.name, [])
+        if bn.name not in output_names and len(following) == 1 and \
+                isinstance(layers[following[0]], Activation):
+            activation = layers[following[0]]
+        fused[conv.name] = (bn, activation)
+
+    # An activation can only become the identity when all of its inputs are folded.
+    fused_bns = {bn.name for bn, _ in fused.values()}
+    for name, (bn, activation) in fused.items():
+        if activation is not None and not set(producers[activation.name]) <= fused_bns:
+            fused[name] = (bn, None)
+    identities = fused_bns | {activation.name for _, activation in fused.values()
+                              if activation is not None}
+
+    def clone_layer(layer):
+        if layer.name in identities:
+            return Activation('linear', name=layer.name, dtype=layer.get_config()['dtype'])
+        layer_config = layer.get_config()
+        if layer.name in fused:
+            layer_config['use_bias'] = True
+            activation = fused[layer.name][1]
+            if activation is not None:
+                layer_config['activation'] = activation.activation
+        return layer.__class__.from_config(layer_config)
+
+    fused_model = clone_model(model, clone_function=clone_layer)
+
+    for layer in fused_model.layers:
+        if layer.name in fused:
+            layer.set_weights(_fold_batch_norm(layers[layer.name], fused[layer.name][0]))
+        elif layer.name not in identities:
+            layer.set_weights(layers[layer.name].get_weights())
+
+    return fused_model
+
+
+def compile_xla(model, batch_size=None):
+    # Wrap a model in an XLA-compiled tf.function traced once for its input shape.
+    """
+    # Arguments
+        model: Keras model instance.
+        batch_size: integer batch size to compile for, or `None` to accept any batch 
+            size at the cost of one XLA compilation per new batch size.
+    # Returns
+        A function mapping a float32 batch of preprocessed images to the model output.
+    """
+    input_spec = tf.TensorSpec((batch_size,) + tuple(K.int_shape(model.input)[1:]), tf.float32)
+    infer = tf.function(lambda x: model(x, training=False), input_signature=[input_spec],
+                        **{_JIT_COMPILE_ARG: True})
+    infer.get_concrete_function()
+
+    def predict(x):
+        return infer(tf.convert_to_tensor(x, dtype=tf.float32)).numpy()
+
+    return predict
+
+
+def to_tensorrt(model, precision='fp16', onnx_path=None, engine_path=None,
+                dynamic_batch=True, max_batch_size=8, calibration_data=None):
+    # Export a Keras model to ONNX and build a serialized TensorRT engine from it.
+    """
+    Supports TensorRT 7.x (the CUDA 11.0 stack) through 10.x.
+    # Arguments
+        model: Keras model instance, for instance the output of `EfficientNetB2()`.
+        precision: string, 'fp32', 'fp16' or 'int8'.
+        onnx_path: path of the intermediate ONNX model, `<model name>.onnx` by default.
+        engine_path: path of the engine, `<model name>_<precision>.engine` by default.
+        dynamic_batch: whether the engine accepts any batch size up to `max_batch_size`
+            instead of a fixed batch size of 1.
+        max_batch_size: integer, the largest batch size of a dynamic engine.
+        calibration_data: float32 array of preprocessed images, required for 'int8'.
+            The ONNX model is quantized with ModelOpt (QDQ nodes) before building.
+    # Returns
+        The path of the serialized TensorRT engine.
+    # Raises
+        ValueError: in case of invalid argument for `precision` or missing 
+            `calibration_data`.
+        RuntimeError: if TensorRT fails to parse the ONNX model or build the engine.
+    """
+    if precision not in TRT_PRECISIONS:
+        raise ValueError('The `precision` argument should be one of '
+                         '{}, got {}'.format(sorted(TRT_PRECISIONS), precision))
+
+    if precision == 'int8' and calibration_data is None:
+        raise ValueError('The `calibration_data` argument is required for int8 engines.')
+
+    # tf2onnx and TensorRT are only needed for deployment, so import them lazily.
+    import tf2onnx
+    import tensorrt as trt
+
+    if onnx_path is None:
+        onnx_path = model.name + '.onnx'
+    if engine_path is None:
+        engine_path = '{}_{}.engine'.format(model.name, precision)
+
+    input_shape = tuple(K.int_shape(model.input)[1:])
+    batch_size = None if dynamic_batch else 1
+    input_signature = (tf.TensorSpec((batch_size,) + input_shape, tf.float32, name='input'),)
+    tf2onnx.convert.from_keras(model, input_signature=input_signature, opset=13,
+                               output_path=onnx_path)
+
+    if precision == 'int8':
+        from modelopt.onnx.quantization import quantize
+
+        quantized_path = os.path.splitext(onnx_path)[0] + '_int8.onnx'
+        quantize(onnx_path=onnx_path, quantize_mode='int8',
+                 calibration_data=np.asarray(calibration_data, dtype=np.float32),
+                 output_path=quantized_path)
+        onnx_path = quantized_path
+
+    logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(logger)
+    network = builder.create_network(
+        1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, logger)
+    with open(onnx_path, 'rb') as f:
+        if not parser.parse(f.read()):
+            errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+            raise RuntimeError('TensorRT could not parse {}:\n{}'.format(
+                onnx_path, '\n'.join(errors)))
+
+    config = builder.create_builder_config()
+    if precision in {'fp16', 'int8'}:
+        # Layers left unquantized by the int8 QDQ pass still run in FP16.
+        config.set_flag(trt.BuilderFlag.FP16)
+    if precision == 'int8':
+        config.set_flag(trt.BuilderFlag.INT8)
+    if dynamic_batch:
+        profile = builder.create_optimization_profile()
+        profile.set_shape(network.get_input(0).name, (1,) + input_shape,
+                          (1,) + input_shape, (max_batch_size,) + input_shape)
+        config.add_optimization_profile(profile)
+    if not hasattr(config, 'set_memory_pool_limit'):
+        # TensorRT < 8.4 defaults to no builder workspace at all.
+        config.max_workspace_size = 1 << 30
+
+    if hasattr(builder, 'build_serialized_network'):
+        serialized_engine = builder.build_serialized_network(network, config)
+    else:
+        # TensorRT 7.x builds the engine first and serializes it afterwards.
+        engine = builder.build_engine(network, config)
+        serialized_engine = engine.serialize() if engine is not None else None
+    if serialized_engine is None:
+        raise RuntimeError('TensorRT could not build an engine from ' + onnx_path)
+    with open(engine_path, 'wb') as f:
+        f.write(serialized_engine)
+
+    return engine_path
+
+
+def load_tensorrt_engine(engine_path):
+    # Deserialize a TensorRT engine and return a function running it on NumPy batches.
+    """
+    Uses the name-based tensor API of TensorRT >= 8.5 when available (required by 
+    TensorRT 10) and the binding-index API of TensorRT 7.x and 8.x otherwise.
+    # Arguments
+        engine_path: path of an engine built by `to_tensorrt()`.
+    # Returns
+        A function mapping a float32 batch of preprocessed images to the model output.
+    # Raises
+        RuntimeError: if TensorRT cannot deserialize the engine, e.g. one built by 
+            another TensorRT version or for another GPU.
+    """
+    import tensorrt as trt
+    import pycuda.autoinit  # Create the CUDA context
+    import pycuda.driver as cuda
+
+    runtime = trt.Runtime(trt.Logger(trt.Logger.WARNING))
+    with open(engine_path, 'rb') as f:
+        engine = runtime.deserialize_cuda_engine(f.read())
+    if engine is None:
+        raise RuntimeError('TensorRT could not deserialize ' + engine_path)
+    context = engine.create_execution_context()
+    stream = cuda.Stream()
+    buffers = {}
+
+    tensor_api = hasattr(context, 'execute_async_v3')
+    if tensor_api:
+        names = [engine.get_tensor_name(i) for i in range(engine.num_io_tensors)]
+        input_name = [name for name in names
+                      if engine.get_tensor_mode(name) == trt.TensorIOMode.INPUT][0]
+        output_name = [name for name in names if name != input_name][0]
+
+    def predict(x):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if tensor_api:
+            context.set_input_shape(input_name, x.shape)
+            output_shape = tuple(context.get_tensor_shape(output_name))
+        else:
+            context.set_binding_shape(0, x.shape)
+            output_shape = tuple(context.get_binding_shape(1))
+        # Reuse the page-locked host and device buffers for each batch shape.
+        if x.shape not in buffers:
+            host_input = cuda.pagelocked_empty(x.shape, np.float32)
+            host_output = cuda.pagelocked_empty(output_shape, np.float32)
+            buffers[x.shape] = (host_input, host_output, cuda.mem_alloc(host_input.nbytes),
+                                cuda.mem_alloc(host_output.nbytes))
+        host_input, host_output, device_input, device_output = buffers[x.shape]
+
+        host_input[...] = x
+        cuda.memcpy_htod_async(device_input, host_input, stream)
+        if tensor_api:
+            context.set_tensor_address(input_name, int(device_input))
+            context.set_tensor_address(output_name, int(device_output))
+            context.execute_async_v3(stream_handle=stream.handle)
+        else:
+            context.execute_async_v2(bindings=[int(device_input), int(device_output)],
+                                     stream_handle=stream.handle)
+        cuda.memcpy_dtoh_async(host_output, device_output, stream)
+        stream.synchronize()
+
+        return host_output.copy()
+
+    return predict
+
+
+def quantize_int8(model, representative_dataset, output_path=None):
+    # Post-training quantize a Keras model to a full-integer TensorFlow Lite model.
+    """
+    # Arguments
+        model: Keras model instance.
+        representative_dataset: generator function yielding lists with one preprocessed 
+            float32 batch; a few hundred ImageNet images calibrate the activation ranges.
+        output_path: path of the quantized model, `<model name>_int8.tflite` by default.
+    # Returns
+        The path of the quantized TensorFlow Lite model.
+    """
+    if output_path is None:
+        output_path = model.name + '_int8.tflite'
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    with open(output_path, 'wb') as f:
+        f.write(converter.convert())
+
+    return output_path
+
+
 def EfficientNetB0(include_top=True, weights='imagenet', input_tensor=None,
                    input_shape=None, pooling=None, num_classes=1000, **kwargs):
 
@@ -481,14 +964,20 @@ setattr(EfficientNetB7, '__doc__', EfficientNet.__doc__)
 
 
 def preprocess_input(x):
-    
-    x = image.img_to_array(x)
-    x = np.expand_dims(x, axis=0)
-    x = np.divide(x, 255.0)
-    x = np.subtract(x, 0.5)
-    output = np.multiply(x, 2.0)
+    # Scale pixels to [-1, 1] in place on a single float32 copy of the image.
+    output = np.array(x, dtype=np.float32)
+    output *= 2.0 / 255.0
+    output -= 1.0
+
+    return output[np.newaxis, ...]
+
 
-    return output
+def load_image(path, target_size=(260,260)):
+    # Read, decode, resize and scale a JPEG image with TensorFlow ops for tf.data.
+    x = tf.io.decode_jpeg(tf.io.read_file(path), channels=3)
+    x = tf.image.resize(x, target_size)
+
+    return x * (2.0 / 255.0) - 1.0
 
 
 if __name__ == '__main__':
@@ -498,10 +987,30 @@ if __name__ == '__main__':
     model.summary()
 
     img_path = '/home/mike/Documents/keras_efficientnet/images/plane.jpg'
-    img = image.load_img(img_path, target_size=(260,260))
-    output = preprocess_input(img)
-    print('Input image shape:', output.shape)
-
-    preds = model.predict(output)
-    print(np.argmax(preds))
-    print('Predicted:', decode_predictions(preds,1))
\ No newline at end of file
+    # Decode the images in parallel and prefetch them while the model is running.
+    dataset = tf.data.Dataset.from_tensor_slices([img_path])
+    dataset = dataset.map(load_image, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.batch(1).prefetch(tf.data.experimental.AUTOTUNE)
+
+    # Run the image through a TensorRT FP16 engine (cached in the working directory) 
+    # when TensorRT is installed, otherwise through the XLA-compiled Keras model. Engines 
+    # only load with the TensorRT version and GPU that built them, so rebuild on failure.
+    try:
+        import tensorrt as trt
+        engine_path = '{}_trt{}_fp16.engine'.format(model.name, trt.__version__)
+        if not os.path.exists(engine_path):
+            to_tensorrt(model, precision='fp16', engine_path=engine_path)
+        try:
+            predict = load_tensorrt_engine(engine_path)
+        except RuntimeError:
+            to_tensorrt(model, precision='fp16', engine_path=engine_path)
+            predict = load_tensorrt_engine(engine_path)
+    except ImportError:
+        predict = compile_xla(model, batch_size=1)
+
+    # The first call includes the cuDNN autotuning and compilation; time later calls.
+    for output in dataset:
+        print('Input image shape:', output.shape)
+        preds = predict(output.numpy())
+        print(np.argmax(preds))
+        print('Predicted:', decode_predictions(preds,1))
\ No newline at end of file
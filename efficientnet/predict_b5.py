@@ -30,14 +30,12 @@ for gpu in gpus:
 
 
 def preprocess_input(x):
-    
-    x = image.img_to_array(x)
-    x = np.expand_dims(x, axis=0)
-    x = np.divide(x, 255.0)
-    x = np.subtract(x, 0.5)
-    output = np.multiply(x, 2.0)
+    # Scale pixels to [-1, 1] in place on a single float32 copy of the image.
+    output = np.array(x, dtype=np.float32)
+    output *= 2.0 / 255.0
+    output -= 1.0
 
-    return output
+    return output[np.newaxis, ...]
 
 
 if __name__ == '__main__':